@@ -0,0 +1,50 @@
+-- Moves users.role, users.gender, ratings.entity_type and ratings.value
+-- from enum labels to the SMALLINT values of the Role, Gender, EntityType
+-- and Grade IntEnums in librekpi.model, with the CHECK constraints the
+-- IntEnumType columns declare.
+--
+-- PostgreSQL, run once in a single transaction before deploying the
+-- IntEnumType columns:
+--
+--     psql -1 -f migrations/enums_to_smallint.sql <database>
+--
+-- The columns are read as text, so native ENUM and VARCHAR columns are both
+-- converted. CHECK constraints on the old labels (created for non-native
+-- enums) have to be dropped first.
+
+ALTER TABLE users
+    ALTER COLUMN role TYPE SMALLINT USING CASE role::text
+        WHEN 'administrator' THEN 1
+        WHEN 'moderator' THEN 2
+        WHEN 'student' THEN 3
+    END,
+    ALTER COLUMN gender TYPE SMALLINT USING CASE gender::text
+        WHEN 'male' THEN 1
+        WHEN 'female' THEN 2
+    END;
+
+ALTER TABLE users
+    ADD CHECK (role IN (1, 2, 3)),
+    ADD CHECK (gender IN (1, 2));
+
+ALTER TABLE ratings
+    ALTER COLUMN entity_type TYPE SMALLINT USING CASE entity_type::text
+        WHEN 'teacher' THEN 1
+        WHEN 'course' THEN 2
+    END,
+    ALTER COLUMN value TYPE SMALLINT USING CASE value::text
+        WHEN 'A' THEN 1
+        WHEN 'B' THEN 2
+        WHEN 'C' THEN 3
+        WHEN 'D' THEN 4
+        WHEN 'E' THEN 5
+        WHEN 'F' THEN 6
+        WHEN 'Fx' THEN 7
+    END;
+
+ALTER TABLE ratings
+    ADD CHECK (entity_type IN (1, 2)),
+    ADD CHECK (value IN (1, 2, 3, 4, 5, 6, 7));
+
+DROP TYPE IF EXISTS role;
+DROP TYPE IF EXISTS gender;
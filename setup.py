@@ -2,7 +2,8 @@ from setuptools import setup, find_packages
 import sys
 
 install_requires = ['redis', 'motor', 'jinja2', 'yuicompressor', 'webassets',
-                    'cssmin', 'PyYAML']
+                    'cssmin', 'PyYAML', 'argon2-cffi>=18.2.0',
+                    'orjson>=3.0']
 # 'Routes'
 
 if sys.version_info == (3,3):           # Python 3.4 introduced `asyncio` in standard library,
@@ -4,32 +4,59 @@ This module descibes DB models/entities implementation
 """
 
 
-import calendar
-import os
+import hmac
 from base64 import b64decode, b64encode
-from datetime import datetime, timedelta
+from datetime import date, datetime
+from enum import IntEnum
 from hashlib import sha256
 
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+
 from sqlalchemy import Column, Integer, UnicodeText, Date, DateTime, String, \
-    BigInteger, Enum, SmallInteger, Float, func, text, \
+    BigInteger, SmallInteger, Float, func, text, \
     Boolean, ForeignKey
 from sqlalchemy.orm import deferred, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import UniqueConstraint, CheckConstraint
 
 Base = declarative_base()
 metadata = Base.metadata
 
 from sqlalchemy.types import TypeDecorator, VARCHAR
 import json
+import orjson
 
 import logging
 
 
 logger = logging.getLogger(__name__)
 
+# OpenSSL picks the SHA extensions (SHA-NI) implementation when the CPU has
+# them, CPython's builtin `_sha256` fallback is generic C code
+logger.debug("SHA-256 is provided by %s.%s", sha256.__module__,
+             sha256.__name__)
+if sha256.__module__ != '_hashlib':
+    logger.warning("hashlib is not linked against OpenSSL, "
+                   "SHA-256 hashing falls back to %s", sha256.__module__)
+
+# each hash or verification takes 64 MiB and tens of milliseconds of CPU,
+# and it runs synchronously, blocking the Tornado IOLoop for that long
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024,
+                                 parallelism=1)
+
+
+def _legacy_salt(salt):
+    """Returns the bytes a legacy SHA-256 password hash was salted with.
+
+    Those hashes were made with ``b64decode(str(salt))`` of the Base64
+    encoded salt bytes, so on Python 3 it was their ``"b'...'"`` repr that got
+    decoded. It has to be reproduced for the stored hashes to verify.
+    """
+    return b64decode(str(b64encode(salt)))
+
 class JSONEncodedDict(TypeDecorator):
     """Represents an immutable structure as a json-encoded string.
 
@@ -40,17 +67,32 @@ class JSONEncodedDict(TypeDecorator):
     """
 
     impl = VARCHAR
+    cache_ok = True
     empty_val = {}
 
-    def process_bind_param(self, value, dialect):
-        logger.debug(value)
+    @staticmethod
+    def process_bind_param(value, dialect):
         if value is not None:
-            value = json.dumps(value)
+            try:
+                # orjson returns bytes, the VARCHAR column wants str
+                value = orjson.dumps(
+                    value, option=orjson.OPT_NON_STR_KEYS).decode('UTF-8')
+            except orjson.JSONEncodeError:
+                # e.g. integers wider than 64 bits, which json handles
+                value = json.dumps(value)
 
         return value
 
     def process_result_value(self, value, dialect):
-        return json.loads(value) if value is not None else self.empty_val
+        if value is None:
+            # a copy, so that filling in one row does not touch the others
+            return self.empty_val.copy()
+
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity, which json.dumps() used to write
+            return json.loads(value)
 
 class JSONEncodedList(JSONEncodedDict):
     """Represents an immutable structure as a json-encoded string.
@@ -63,9 +105,92 @@ class JSONEncodedList(JSONEncodedDict):
 
     empty_val = []
 
+class Base64Bytes(TypeDecorator):
+    """Represents a byte string as its Base64 encoded text.
+
+    Usage:
+
+        Base64Bytes(12)
+
+    """
+
+    impl = VARCHAR
+    cache_ok = True
+
+    @staticmethod
+    def process_bind_param(value, dialect):
+        if isinstance(value, str):
+            raise TypeError("Base64Bytes takes raw bytes, "
+                            "not their Base64 encoded str")
+        return b64encode(value).decode('ascii') if value is not None else None
+
+    @staticmethod
+    def process_result_value(value, dialect):
+        return b64decode(value) if value is not None else None
+
+class IntEnumType(TypeDecorator):
+    """Represents an :class:`~enum.IntEnum` member as its small integer
+    value. Member names are accepted on assignment as well.
+
+    Usage:
+
+        IntEnumType(Role)
+
+    """
+
+    impl = SmallInteger
+    cache_ok = True  # enum_class is hashable and safe as a cache key
+
+    def __init__(self, enum_class, *args, **kwargs):
+        super(IntEnumType, self).__init__(*args, **kwargs)
+        self.enum_class = enum_class
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            value = self.enum_class[value]
+
+        return int(self.enum_class(value)) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return self.enum_class(value) if value is not None else None
+
+
+def enum_check(column_name, enum_class):
+    """Returns a CHECK constraint limiting an :class:`IntEnumType` column to
+    the values of `enum_class`, as the native enum type did"""
+    return CheckConstraint("%s IN (%s)" % (
+        column_name, ", ".join(str(int(m)) for m in enum_class)))
+
+
+class Role(IntEnum):
+    administrator = 1
+    moderator = 2
+    student = 3  # not need for `teacher` role
+
+
+class Gender(IntEnum):
+    male = 1
+    female = 2
+
+
+class EntityType(IntEnum):
+    teacher = 1
+    course = 2
+
+
+class Grade(IntEnum):
+    A = 1
+    B = 2
+    C = 3
+    D = 4
+    E = 5
+    F = 6
+    Fx = 7
+
 __all__ = ["User", "SocialAuth",
            "Teacher", "Course",
-           "Comment", "Rating"]
+           "Comment", "Rating",
+           "Role", "Gender", "EntityType", "Grade"]
 
 
 class User(Base):
@@ -82,36 +207,33 @@ class User(Base):
     id = Column(Integer, autoincrement=True, primary_key=True)
     fbid = Column(BigInteger, unique=True, index=True)  # ?
     username = Column(String(35), unique=True, index=True)
-    role = Column(Enum('administrator', 'moderator', 'student',  # not need for `teacher` role
-                       name="role"), default='student', nullable=False)
+    role = Column(IntEnumType(Role), enum_check("role", Role),
+                  default=Role.student, nullable=False)
 
     displayname = Column(String(64), nullable=False)
 
     email = Column(String(64), unique=True, nullable=False, index=True)
 
-    _salt = Column("salt", String(12))
+    # salt of a legacy SHA-256 password hash, argon2 hashes embed their own
+    _salt = Column("salt", Base64Bytes(12))
 
     @hybrid_property
     def salt(self):
-        """Generates a cryptographically random salt and sets its Base64 encoded
-        version to the salt column, and returns the encoded salt.
+        """Returns the salt of a legacy SHA-256 password hash or ``None`` if
+        the password is hashed with argon2.
         """
-        if not self.id and not self._salt:
-            self._salt = b64encode(os.urandom(8))
-
-        if isinstance(self._salt, str):
-            self._salt = self._salt.encode('UTF-8')
-
         return self._salt
 
-    # 64 is the length of the SHA-256 encoded string length
-    _password = Column("password", String(64))
+    # 128 fits the argon2 encoded hash as well as a legacy SHA-256 hex digest
+    _password = Column("password", String(128))
 
     def __encrypt_password(self, password, salt):
         """
         Encrypts the password with the given salt using SHA-256. The salt must
         be cryptographically random bytes.
 
+        Only used to check passwords hashed before the switch to argon2.
+
         :param password: the password that was provided by the user to try and
                          authenticate. This is the clear text version that we
                          will need to match against the encrypted one in the
@@ -128,15 +250,8 @@ class User(Base):
         else:
             password_bytes = password
 
-        hashed_password = sha256()
-        hashed_password.update(password_bytes)
-        hashed_password.update(salt)
-        hashed_password = hashed_password.hexdigest()
-
-        if not isinstance(hashed_password, str):
-            hashed_password = hashed_password.decode("UTF-8")
-
-        return hashed_password
+        # a single call instead of update() twice
+        return sha256(password_bytes + salt).hexdigest()
 
     @hybrid_property
     def password(self):
@@ -144,8 +259,8 @@ class User(Base):
 
     @password.setter
     def password(self, password):
-        self._password = self.__encrypt_password(password,
-                                                 b64decode(str(self.salt)))
+        self._password = password_hasher.hash(password)
+        self._salt = None
 
     def validate_password(self, password):
         """Check the password against existing credentials.
@@ -154,25 +269,45 @@ class User(Base):
         :param password: clear text password
         :rtype: bool
         """
-        return self.password == self.__encrypt_password(password,
-                                                        b64decode(str(self.salt)))
+        if self.salt:
+            expected = self.__encrypt_password(password,
+                                               _legacy_salt(self.salt))
+            return hmac.compare_digest(self._password or "", expected)
+
+        try:
+            return password_hasher.verify(self._password or "", password)
+        except (VerificationError, InvalidHash):
+            return False
+
+    @property
+    def password_needs_rehash(self):
+        """Whether the password is stored as a legacy SHA-256 hash or with
+        outdated argon2 parameters. Meant to be checked after a successful
+        :meth:`validate_password`, so that the clear text password can be set
+        again and the user saved.
+        """
+        return bool(self.salt) or \
+            password_hasher.check_needs_rehash(self._password)
 
 
     city = Column(String(30), default=None, index=True)
 
-    gender = Column(Enum('male', 'female', name="gender"), nullable=True)
+    gender = Column(IntEnumType(Gender), enum_check("gender", Gender),
+                    nullable=True)
     date_of_birth = Column(Date)
 
     @hybrid_property
     def age(self):
-        """Property calculated from (current time - :attr:`User.date_of_birth` - leap days)"""
-        if self.date_of_birth:
-            today = (datetime.utcnow() + timedelta(hours=self.timezone)).date()
-            birthday = self.date_of_birth
-            if isinstance(birthday, datetime):
-                birthday = birthday.date()
-            age = today - (birthday or (today - timedelta(1)))
-            return (age.days - calendar.leapdays(birthday.year, today.year)) / 365
+        """Full years passed since :attr:`User.date_of_birth` in the user's
+        timezone"""
+        birthday = self.date_of_birth
+        if birthday:
+            now = datetime.utcnow()
+            # shift the UTC date by the days the timezone offset crosses
+            today = date.fromordinal(
+                now.toordinal() + (now.hour + (self.timezone or 0)) // 24)
+            return today.year - birthday.year - \
+                ((today.month, today.day) < (birthday.month, birthday.day))
         return -1
 
     @age.expression
@@ -224,6 +359,12 @@ class Teacher(Base):
     def __init__(self, **kwargs):
         super(Teacher, self).__init__(**kwargs)
 
+    @classmethod
+    def listing_columns(cls):
+        """Columns rendered in teacher lists, to be selected as plain rows
+        instead of loading whole instances"""
+        return (cls.id, cls.name, cls.midinit, cls.surname, cls.faculty)
+
     id = Column(Integer, autoincrement=True, primary_key=True)
 
     name = Column(String(35), nullable=False)           # ім’я
@@ -231,7 +372,9 @@ class Teacher(Base):
     surname = Column(String(35), nullable=False)        # прізвище
 
     photo = deferred(Column(UnicodeText))
-    courses = relationship("Course", backref="teacher")
+    # costs one extra IN query per batch of loaded teachers, single teacher
+    # pages included; list views select `listing_columns` and never load it
+    courses = relationship("Course", lazy='selectin', backref="teacher")
 
     faculty = Column(String(64), nullable=False)        # where teacher works
     departments = deferred(Column(JSONEncodedList(512)))   # where he tells lectures
@@ -266,6 +409,12 @@ class Course(Base):
     def __init__(self, **kwargs):
         super(Course, self).__init__(**kwargs)
 
+    @classmethod
+    def listing_columns(cls):
+        """Columns rendered in course lists, to be selected as plain rows
+        instead of loading whole instances"""
+        return (cls.id, cls.title, cls.teacher_id)
+
     id = Column(Integer, autoincrement=True, primary_key=True)
 
     icon = deferred(Column(UnicodeText))
@@ -298,9 +447,11 @@ class Rating(Base):
 
     id = Column(Integer, autoincrement=True, primary_key=True)
 
-    entity_type = Column(Enum('teacher', 'course'), nullable=False)
+    entity_type = Column(IntEnumType(EntityType),
+                         enum_check("entity_type", EntityType), nullable=False)
     entity_id = Column(Integer, nullable=False)
-    value = Column(Enum('A', 'B', 'C', 'D', 'E', 'F', 'Fx'), nullable=False)
+    value = Column(IntEnumType(Grade), enum_check("value", Grade),
+                   nullable=False)
     voter = relationship('User', backref='votes')
 
 
@@ -5,6 +5,7 @@ for content rendering
 """
 
 import json
+from enum import Enum
 import tornado
 
 import os
@@ -14,6 +15,19 @@ from jinja2 import TemplateNotFound
 from librekpi.model import Document
 
 
+def _jsonable(obj):
+    """Replaces enum members, which json renders as their bare integer values,
+    with their names
+    """
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, dict):
+        return {k: _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    return obj
+
+
 class TemplateRendering:
     """
     A simple class to hold methods for rendering templates.
@@ -82,7 +96,7 @@ class JSONHandler(tornado.web.RequestHandler):
                     _tmp[field] = _tmp[field].decode()
             obj = _tmp
             del _tmp
-        json.dump(obj, self)
+        json.dump(_jsonable(obj), self)
 
     """Handler with JSON output"""
     def _return(self, obj):